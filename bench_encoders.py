@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from osgeo import gdal
+
+from gdal2kml import BufferPool, ENCODERS, read_window, tile_edges, tiles
+
+
+def bench(source: str | Path,
+          encoders: list[str],
+          tile_size: int = 1024,
+          count: int = 8,
+          quality: int = 75,
+          repeat: int = 3) -> list[dict]:
+    """
+    Time each encoder on the same tiles from the source image and return one result per encoder.
+    The tiles are read once up front so only the encoding is timed.
+    """
+    img = gdal.Open(str(source))
+    if img is None:
+        raise (AttributeError('Not a valid georeferenced image:', source))
+
+    img_size = [img.RasterXSize, img.RasterYSize]
+    tile_layout = tiles(img_size, tile_size)
+    x_edges, y_edges = tile_edges(img_size[0], tile_layout[0]), tile_edges(img_size[1], tile_layout[1])
+
+    pool = BufferPool()
+    buffers = []
+    for t_y in range(tile_layout[1]):
+        for t_x in range(tile_layout[0]):
+            if len(buffers) < count:
+                offset = (x_edges[t_x], y_edges[t_y])
+                size = [x_edges[t_x + 1] - x_edges[t_x], y_edges[t_y + 1] - y_edges[t_y]]
+                buffers.append(read_window(img, offset, size, pool))
+
+    megapixels = sum(data.shape[1] * data.shape[2] for data in buffers) / 1e6
+
+    results = []
+    for name in encoders:
+        encode = ENCODERS[name]
+        sizes = [len(encode(data, quality)) for data in buffers]
+
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for data in buffers:
+                encode(data, quality)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        results.append({
+            'encoder': name,
+            'tiles': len(buffers),
+            'seconds': best,
+            'megapixels_per_second': megapixels / best,
+            'mean_bytes': sum(sizes) / len(sizes),
+        })
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the JPEG encoders on tiles from a georeferenced image')
+
+    parser.add_argument('src_file', metavar='src_file', type=str, help='source file')
+
+    parser.add_argument('-e', '--encoder', dest='encoders', action='append', choices=sorted(ENCODERS),
+                        help='Encoder to time, may be repeated [all]')
+    parser.add_argument('-t', '--tile-size', dest='tile_size', default=1024, type=int, help='Max tile size [1024]')
+    parser.add_argument('-n', '--count', dest='count', default=8, type=int, help='Number of tiles to encode [8]')
+    parser.add_argument('-q', '--quality', dest='quality', default=75, type=int, help='JPEG quality [75]')
+    parser.add_argument('-r', '--repeat', dest='repeat', default=3, type=int, help='Best of this many runs [3]')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if not Path(args.src_file).exists():
+        parser.error('unable to find src_file')
+
+    results = bench(args.src_file, args.encoders or sorted(ENCODERS),
+                    tile_size=args.tile_size,
+                    count=args.count,
+                    quality=args.quality,
+                    repeat=args.repeat)
+
+    print(f"{'encoder':<10} {'tiles':>6} {'seconds':>9} {'MP/s':>8} {'bytes/tile':>11}")
+    for result in results:
+        print(f"{result['encoder']:<10} {result['tiles']:>6} {result['seconds']:>9.3f} "
+              f"{result['megapixels_per_second']:>8.1f} {result['mean_bytes']:>11.0f}")
@@ -1,45 +1,84 @@
 from __future__ import annotations
 
 import argparse
+import glob
+import hashlib
+import io
+import json
 import logging
 import math
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
+from multiprocessing import shared_memory
 from pathlib import Path
+from typing import Iterator
 
+import numpy as np
 import osgeo.gdal
 from osgeo import gdal
+from osgeo import gdal_array
 from osgeo import osr
 
+from stats import Stats
 
-def tiles(canvas_shape: list[int, int], target: int = 1024) -> list[int]:
-    """
-    Brute force algorithm to determine the most efficient tiling method for a given canvas
-    If anyone can figure out a prettier one please let me know - is actually harder then you'd think!
-    """
-    best_case = (canvas_shape[0] * canvas_shape[1]) / float(target ** 2)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Largest side the JPEG format allows
+JPEG_MAX_SIDE = 65500
 
-    # Handle the trivial cases first
-    if canvas_shape[0] <= target:
-        return [1, math.ceil(best_case)]
 
-    if canvas_shape[1] <= target:
-        return [math.ceil(best_case), 1]
+def tiles(canvas_shape: list[int, int], target: int = 1024, max_pixels: int = None) -> list[int]:
+    """
+    Find the [columns, rows] layout with the fewest tiles no larger than target on either side.
+    Ties go to the layout that wastes the fewest pixels if every tile were the full size, which
+    is the one with the most even tiles, and then to the squarest tiles.
+
+    With max_pixels the tiles can be any shape as long as each has no more than max_pixels
+    pixels, so long narrow canvases can use long narrow tiles.
+    """
+    width, height = canvas_shape
+    if max_pixels is None:
+        max_side, max_pixels = target, target ** 2
+    else:
+        max_side = min(max_pixels, JPEG_MAX_SIDE)
 
-    r = [float(x) / target for x in canvas_shape]
+    best = None
+    columns = math.ceil(width / max_side)
+    # There are never fewer rows than this, so once it is exceeded more columns only add tiles
+    min_rows = math.ceil(height / max_side)
+    while best is None or columns * min_rows <= best[0]:
+        tile_width = math.ceil(width / columns)
+        rows = max(min_rows, math.ceil(height / (max_pixels // tile_width)))
+        tile_height = math.ceil(height / rows)
 
-    # Brute force the 4 methods
-    a_up = [math.ceil(x) for x in r]
-    b_up = [math.ceil(best_case / x) for x in a_up]
+        waste = columns * rows * tile_width * tile_height - width * height
+        aspect = max(tile_width, tile_height) / min(tile_width, tile_height)
+        candidate = (columns * rows, waste, aspect, columns, rows)
+        if best is None or candidate < best:
+            best = candidate
+        columns += 1
 
-    a_down = [math.floor(x) for x in r]
-    b_down = [math.ceil(best_case / x) for x in a_down]
+    return [best[3], best[4]]
 
-    results = []
-    for i in range(2):
-        results.append((a_up[i], b_up[i], a_up[i] * b_up[i]))
-        results.append((a_down[i], b_down[i], a_down[i] * b_down[i]))
 
-    results.sort(key=lambda x: x[2])
-    return [int(x) for x in results[0][0:2]]
+def tile_edges(length: int, count: int) -> list[int]:
+    """
+    Split length pixels into count tiles, spreading the remainder so they differ by at most one pixel.
+    Returns the count + 1 edges.
+    """
+    return [i * length // count for i in range(count + 1)]
 
 
 def transform(x: int, y: int, geotransform: tuple[int]) -> tuple[int, int]:
@@ -49,29 +88,189 @@ def transform(x: int, y: int, geotransform: tuple[int]) -> tuple[int, int]:
     return xt, yt
 
 
-def create_tile(img: osgeo.gdal.Dataset,
-                filename: str,
+class BufferPool:
+    """
+    Reusable numpy buffers keyed by shape and type. The tiles in a grid only come in a
+    couple of sizes, so after the first row every read lands in memory that is already allocated.
+    Safe to share between the threads of a pipeline.
+    """
+
+    def __init__(self):
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        with self._lock:
+            free = self._free.get((tuple(shape), np.dtype(dtype)))
+            if free:
+                return free.pop()
+        return np.empty(shape, dtype)
+
+    def release(self, buf: np.ndarray) -> None:
+        with self._lock:
+            self._free.setdefault((buf.shape, buf.dtype), []).append(buf)
+
+
+class TileCache:
+    """
+    On-disk cache of encoded tiles keyed by the pixels and the encoding settings, so re-runs
+    only re-encode tiles whose pixels changed. Files are touched when used and the least
+    recently used ones are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory: str | Path, max_bytes: int = 1024 ** 3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.size = sum(f.stat().st_size for f in self.directory.glob('*.jpg'))
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Worker processes get their own lock
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data: np.ndarray, quality: int, encoder: str) -> str:
+        digest = hashlib.sha256(np.ascontiguousarray(data))
+        digest.update(f'{data.shape}:{data.dtype}:{quality}:{encoder}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        path = self.directory / f'{key}.jpg'
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another thread or process since it was read, the data is still good
+            pass
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.directory / f'{key}.jpg'
+        # Write to a temporary name first so other processes never see a partial tile
+        tmp = path.with_suffix(f'.{uuid.uuid4().hex}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used tiles until the cache fits in max_bytes.
+        Called with the lock held.
+        """
+        entries = []
+        for f in self.directory.glob('*.jpg'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort()
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, f in entries:
+            if self.size <= self.max_bytes:
+                break
+            logging.debug(f'Evicting {f.name} from tile cache')
+            f.unlink(missing_ok=True)
+            self.size -= size
+
+
+# Pool used when encode_tile reads a single tile of its own pixels, one per process.
+# Runs that read whole strips use a pool of their own, so the strips go when the run ends.
+_buffers = BufferPool()
+
+
+def read_window(img: osgeo.gdal.Dataset,
                 offset: tuple[int, int],
                 size: list[int],
-                quality: int = 75) -> dict[str, int]:
+                pool: BufferPool) -> np.ndarray:
     """
-    Create a jpeg of the given area and return the bounds.
+    Read a window of all bands straight into a (bands, rows, cols) buffer from the pool.
+    Give the buffer back with pool.release() once it has been encoded.
     """
-    mem_drv = gdal.GetDriverByName('MEM')
-    mem_ds = mem_drv.Create('', size[0], size[1], img.RasterCount)
-    bands = range(1, img.RasterCount + 1)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(img.GetRasterBand(1).DataType)
+    buf = pool.acquire((img.RasterCount, size[1], size[0]), dtype)
+    img.ReadAsArray(offset[0], offset[1], size[0], size[1], buf_obj=buf if img.RasterCount > 1 else buf[0])
+    return buf
 
-    # TODO: consider this instead https://rasterio.readthedocs.io/en/latest/
-    data = img.ReadRaster(offset[0], offset[1], size[0], size[1], size[0], size[1], band_list=bands)
-    mem_ds.WriteRaster(0, 0, size[0], size[1], data, band_list=bands)
-    # Error comes because we go out of bounds of image?
 
-    # Save tiles as jpeg
+def read_vsimem(filename: str) -> bytes:
+    """
+    Read back a file written to GDAL's in-memory filesystem and release it.
+    """
+    f = gdal.VSIFOpenL(filename, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+
+    gdal.Unlink(filename)
+    # The JPEG driver may leave a sidecar behind
+    gdal.Unlink(f'{filename}.aux.xml')
+
+    return data
+
+
+def encode_gdal(data: np.ndarray, quality: int = 75) -> bytes:
+    """
+    Encode a (bands, rows, cols) buffer with GDAL's JPEG driver.
+    """
+    filename = f'/vsimem/{uuid.uuid4().hex}.jpg'
+
+    # Wrap the buffer as a dataset in place rather than copying it into a new MEM dataset
+    mem_ds = gdal_array.OpenArray(data)
     jpeg_drv = gdal.GetDriverByName('JPEG')
     jpeg_drv.CreateCopy(filename, mem_ds, strict=0, options=["QUALITY={0}".format(quality)])
+    mem_ds = None
+
+    return read_vsimem(filename)
+
+
+def encode_pillow(data: np.ndarray, quality: int = 75) -> bytes:
+    """
+    Encode a (bands, rows, cols) buffer with Pillow, which uses libjpeg-turbo in the standard wheels.
+    """
+    if Image is None:
+        raise ImportError('The pillow encoder needs Pillow installed')
+    if data.dtype != np.uint8:
+        raise ValueError(f'The pillow encoder only handles 8 bit data, not {data.dtype}')
+
+    if data.shape[0] < 3:
+        image = Image.fromarray(np.ascontiguousarray(data[0]))
+    else:
+        # JPEG has no alpha, so only the first three bands are used
+        image = Image.fromarray(np.ascontiguousarray(np.moveaxis(data[:3], 0, -1)))
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality)
+    return out.getvalue()
+
+
+ENCODERS = {
+    'gdal': encode_gdal,
+    'pillow': encode_pillow,
+}
 
-    geotransform = img.GetGeoTransform()
 
+def tile_bounds(geotransform: tuple[float], offset: tuple[int, int], size: list[int]) -> dict[str, float]:
+    """
+    Work out the lat/lon bounds of a pixel window.
+    """
     if geotransform[2] != 0 or geotransform[4] != 0:
         raise Exception('Source projection incompatible, transform contains rotation')
     else:
@@ -88,114 +287,1459 @@ def create_tile(img: osgeo.gdal.Dataset,
     return result
 
 
-def create_kml(source: str | Path,
-               filename: str | Path,
-               directory: str | Path,
-               tile_size: int = 1024,
-               border: int = 0,
-               name: str = None,
-               order: int = 20,
-               exclude: list[str] = None,
-               quality: int = 75) -> None:
+def band_masks(img: osgeo.gdal.Dataset) -> list[tuple[bool, float | None]]:
     """
-    Create a kml file and associated images for the given georeferenced image 
+    Whether each band is alpha, and its nodata value, looked up once so that threads can check
+    pixels with valid_mask without touching the dataset while another thread reads from it.
     """
+    bands = []
+    for i in range(img.RasterCount):
+        band = img.GetRasterBand(i + 1)
+        bands.append((band.GetColorInterpretation() == gdal.GCI_AlphaBand, band.GetNoDataValue()))
+    return bands
 
-    source, filename, directory = Path(source), Path(filename), Path(directory)
 
-    if exclude is None:
-        exclude = []
+def valid_mask(img: osgeo.gdal.Dataset,
+               data: np.ndarray,
+               bands: list[tuple[bool, float | None]] = None) -> np.ndarray | None:
+    """
+    Mask of the pixels in a (bands, rows, cols) buffer that hold data, going by the
+    nodata values and any alpha band of the source. None if the source has neither.
+    The band_masks can be given instead of being looked up from img.
+    """
+    if bands is None:
+        bands = band_masks(img)
 
-    img = gdal.Open(str(source))
-    if img is None:
-        raise (AttributeError('Not a valid georeferenced image:', source))
-    projection = img.GetProjection()
-    logging.info(projection)
+    valid = np.ones(data.shape[1:], dtype=bool)
+    nodata = np.ones(data.shape[1:], dtype=bool)
+    has_alpha = has_nodata = False
 
-    # https://gdal.org/user/raster_data_model.html#raster-data-model
-    srs = osr.SpatialReference(wkt=projection)
-    authority = (srs.GetAttrValue('AUTHORITY', 0), srs.GetAttrValue('AUTHORITY', 1))
-    logging.debug(authority)
+    for i, (alpha, nodata_value) in enumerate(bands):
+        if alpha:
+            has_alpha = True
+            valid &= data[i] > 0
+        elif nodata_value is not None:
+            has_nodata = True
+            nodata &= data[i] == nodata_value
 
-    if authority != ('EPSG', '4326'):
-        # https://gdal.org/tutorials/osr_api_tut.html#coordinate-transformation
-        # ct = osr.CoordinateTransformation()
-        errmsg = f'Input file is not in standard CRS. Should be EPSG 4326 but is {authority[0]} {authority[1]}'
-        logging.error(errmsg)
-        raise NotImplementedError(errmsg)
+    if not has_alpha and not has_nodata:
+        return None
+    if has_nodata:
+        valid &= ~nodata
 
-    img_size = [img.RasterXSize, img.RasterYSize]
-    logging.debug(f'Image size: {img_size}')
-    cropped_size = [x - border * 2 for x in img_size]
+    return valid
 
-    base, ext = source.stem, source.suffix
 
-    if not name:
-        name = base
-    path = directory.relative_to(filename.parent)
+def tile_coverage(img: osgeo.gdal.Dataset,
+                  data: np.ndarray,
+                  bands: list[tuple[bool, float | None]] = None) -> float:
+    """
+    Fraction of the pixels in a (bands, rows, cols) buffer that hold data.
+    """
+    valid = valid_mask(img, data, bands)
+    return 1.0 if valid is None else float(valid.mean())
 
-    tile_layout = tiles(cropped_size, tile_size)
 
-    tile_sizes = [int(math.floor(x)) for x in [cropped_size[0] / tile_layout[0], cropped_size[1] / tile_layout[1]]]
-    logging.debug(f'Using tile layout {tile_layout} -> {tile_sizes}')
+def collar_mask(img: osgeo.gdal.Dataset, data: np.ndarray) -> np.ndarray:
+    """
+    Mask of the pixels that are part of the map rather than the collar around it. Without
+    nodata or alpha that is anything not black, which is what gdalwarp fills with.
+    """
+    valid = valid_mask(img, data)
+    if valid is None:
+        valid = (data != 0).any(axis=0)
+    return valid
 
-    bob = open(filename, 'w')
 
-    bob.write(f"""<?xml version="1.0" encoding="UTF-8"?>
-             <kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" 
-             xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
-               <Folder>
-                 <name>{name}</name>
-             """)
+def detect_collar(img: osgeo.gdal.Dataset, threshold: float = 0.0, overview: int = 1024) -> tuple[int, int, int, int]:
+    """
+    Find the collar around the map on each side, as (left, top, right, bottom) pixels to crop.
+    A decimated copy no bigger than overview pixels (read from the overviews if the source has
+    them) is scanned for the first and last rows and columns with more than threshold of their
+    pixels on the map, then only the pixels around those edges are read at full resolution.
+    """
+    width, height = img.RasterXSize, img.RasterYSize
+    factor = max(1, math.ceil(max(width, height) / overview))
+    small = img.ReadAsArray(0, 0, width, height,
+                            buf_xsize=math.ceil(width / factor), buf_ysize=math.ceil(height / factor))
+    if small.ndim == 2:
+        small = small[np.newaxis]
+
+    mask = collar_mask(img, small)
+    rows = np.flatnonzero(mask.mean(axis=1) > threshold)
+    columns = np.flatnonzero(mask.mean(axis=0) > threshold)
+    if not len(rows) or not len(columns):
+        logging.warning('No map found inside the collar, not cropping')
+        return 0, 0, 0, 0
+
+    scale_x, scale_y = width / small.shape[2], height / small.shape[1]
+
+    def span(first: int, last: int, scale: float, length: int) -> tuple[int, int]:
+        # Full resolution pixels covering coarse pixels first to last, with one to spare either side
+        return max(0, math.floor((first - 1) * scale)), min(length, math.ceil((last + 2) * scale))
+
+    # Only the part of each edge alongside the map is read, not the collar beyond its ends
+    across_x = span(columns[0], columns[-1], scale_x, width)
+    across_y = span(rows[0], rows[-1], scale_y, height)
+
+    def refine(index: int, scale: float, length: int, vertical: bool, first: bool) -> int:
+        # Read the full resolution pixels either side of the coarse edge and find the exact one
+        start, stop = span(index, index, scale, length)
+        if vertical:
+            data = img.ReadAsArray(across_x[0], start, across_x[1] - across_x[0], stop - start)
+        else:
+            data = img.ReadAsArray(start, across_y[0], stop - start, across_y[1] - across_y[0])
+        if data.ndim == 2:
+            data = data[np.newaxis]
+
+        # As a fraction of the whole row or column, the same as the decimated scan
+        found = np.flatnonzero(collar_mask(img, data).sum(axis=1 if vertical else 0) /
+                               (width if vertical else height) > threshold)
+        if not len(found):
+            return round((index if first else index + 1) * scale)
+        return start + int(found[0] if first else found[-1] + 1)
+
+    left = refine(columns[0], scale_x, width, False, True)
+    right = refine(columns[-1], scale_x, width, False, False)
+    top = refine(rows[0], scale_y, height, True, True)
+    bottom = refine(rows[-1], scale_y, height, True, False)
+
+    collar = (left, top, width - right, height - bottom)
+    logging.debug(f'Detected collar {collar}')
+    return collar
+
+
+def parse_border(value: str) -> int | str:
+    """
+    Read a --crop value, either a number of pixels or 'auto'.
+    """
+    if value == 'auto':
+        return value
+    return int(value)
+
+
+def is_blank(img: osgeo.gdal.Dataset,
+             data: np.ndarray,
+             min_coverage: float = 0.0,
+             bands: list[tuple[bool, float | None]] = None) -> bool:
+    """
+    Check if a tile is not worth including, either because it is a single colour
+    or because no more than min_coverage of it holds data.
+    """
+    if (data == data[:, :1, :1]).all():
+        return True
+
+    coverage = tile_coverage(img, data, bands)
+    return coverage == 0 or coverage < min_coverage
+
+
+def encode_tile(img: osgeo.gdal.Dataset,
+                offset: tuple[int, int],
+                size: list[int],
+                quality: int = 75,
+                data: np.ndarray = None,
+                encoder: str = 'gdal',
+                cache: TileCache = None,
+                min_coverage: float = None,
+                bands: list[tuple[bool, float | None]] = None) -> bytes | None:
+    """
+    Encode the given area as a jpeg and return the data.
+    If the pixels have already been read (bands, rows, cols) they can be passed as data.
+    With min_coverage, blank tiles (see is_blank) are skipped and None is returned.
+    With both data and bands, img isn't touched, so it can be read from by another thread meanwhile.
+    """
+    pooled = data is None
+    if pooled:
+        data = read_window(img, offset, size, _buffers)
+
+    try:
+        if min_coverage is not None and is_blank(img, data, min_coverage, bands):
+            logging.debug(f'Skipping blank tile at {offset}')
+            return None
+
+        if cache is None:
+            return ENCODERS[encoder](data, quality)
+
+        key = cache.key(data, quality, encoder)
+        jpeg = cache.get(key)
+        if jpeg is None:
+            jpeg = ENCODERS[encoder](data, quality)
+            cache.put(key, jpeg)
+        else:
+            logging.debug(f'Tile at {offset} found in cache')
+        return jpeg
+    finally:
+        if pooled:
+            _buffers.release(data)
+
+
+def create_tile(img: osgeo.gdal.Dataset,
+                filename: str,
+                offset: tuple[int, int],
+                size: list[int],
+                quality: int = 75,
+                data: np.ndarray = None,
+                encoder: str = 'gdal',
+                cache: TileCache = None,
+                min_coverage: float = None) -> dict[str, int] | None:
+    """
+    Create a jpeg of the given area and return the bounds.
+    If the pixels have already been read (bands, rows, cols) they can be passed as data.
+    With min_coverage, blank tiles are skipped and None is returned instead.
+    """
+    bounds = tile_bounds(img.GetGeoTransform(), offset, size)
+
+    jpeg = encode_tile(img, offset, size, quality, data, encoder, cache, min_coverage)
+    if jpeg is None:
+        return None
+
+    with open(filename, 'wb') as f:
+        f.write(jpeg)
+
+    return bounds
+
+
+def cache_strips(img: osgeo.gdal.Dataset, strip_width: int, strip_height: int) -> None:
+    """
+    Make sure GDAL's block cache can hold every block touched by one strip read, so blocks
+    straddling two strips are still cached when the next strip is read rather than decoded twice.
+    """
+    band = img.GetRasterBand(1)
+    block_width, block_height = band.GetBlockSize()
+    logging.debug(f'Source block size {block_width}x{block_height}')
+
+    block_columns = math.ceil(strip_width / block_width) + 1
+    block_rows = math.ceil(strip_height / block_height) + 1
+    pixel_bytes = gdal.GetDataTypeSize(band.DataType) // 8
+    needed = block_columns * block_width * block_rows * block_height * pixel_bytes * img.RasterCount
+
+    if gdal.GetCacheMax() < needed:
+        logging.debug(f'Raising GDAL block cache to {needed} bytes')
+        gdal.SetCacheMax(needed)
+
+
+def tile_rows(windows: list[tuple]) -> Iterator[tuple[range, tuple[int, int], list[int]]]:
+    """
+    Group (offset, size) windows given in grid order into the rows of tiles sharing a strip,
+    yielding the range of indexes in each row with the offset and size of its strip.
+    """
+    i = 0
+    while i < len(windows):
+        y, height = windows[i][0][1], windows[i][1][1]
+        j = i
+        while j < len(windows) and windows[j][0][1] == y and windows[j][1][1] == height:
+            j += 1
+
+        x = min(offset[0] for offset, _ in windows[i:j])
+        width = max(offset[0] + size[0] for offset, size in windows[i:j]) - x
+        yield range(i, j), (x, y), [width, height]
+
+        i = j
+
+
+def pipeline_tiles(img: osgeo.gdal.Dataset,
+                   tasks: list[tuple],
+                   cache: TileCache = None,
+                   threads: int = 1,
+                   depth: int = 8,
+                   stats: Stats = None) -> Iterator[tuple[dict[str, int], bytes | None]]:
+    """
+    Run render_tile for a list of args in three stages that overlap: a reader thread reads
+    each row of tiles as a strip ahead of time, a pool of encoder threads encodes the tiles, and
+    the results are yielded in order to the caller, which writes them out as the last stage.
+
+    No more than depth tiles are between the stages at once, so the fastest stage waits on
+    the slowest instead of filling memory. The read and encode stages are recorded in stats,
+    along with the time each stage spent waiting and the depths of the queues between them.
+    The strips are read into a pool of their own that goes once the tiles are done.
+    """
+    if threads < 1 or depth < 1:
+        raise ValueError('The pipeline needs at least one encoder thread and room for one tile')
+
+    if stats is None:
+        stats = Stats()
+    pool = BufferPool()
+    waits = stats.values['pipeline'] = {
+        'threads': threads,
+        'depth': depth,
+        'read_wait_seconds': 0.0,
+        'write_wait_seconds': 0.0,
+        'encode_queue_max': 0,
+        'encode_queue_mean': 0.0,
+        'write_queue_max': 0,
+        'write_queue_mean': 0.0,
+    }
+    if not tasks:
+        return
+
+    windows = [(args[1], args[2]) for args in tasks]
+    strip_width = max(offset[0] + size[0] for offset, size in windows) - min(offset[0] for offset, _ in windows)
+    cache_strips(img, strip_width, max(size[1] for _, size in windows))
+
+    # The reader thread has the dataset to itself, the encoders only need to know the masks
+    bands = band_masks(img)
+
+    slots = threading.Semaphore(depth)
+    to_encode = queue.Queue(depth + threads)
+    to_write = queue.Queue()
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    def reader():
+        encode_depths = []
+        try:
+            for row, offset, size in tile_rows(windows):
+                with stats.timed('read', pixels=size[0] * size[1]) as counts:
+                    strip = read_window(img, offset, size, pool)
+                    counts['bytes'] = strip.nbytes
+
+                # The strip goes back to the pool once the last of its tiles is encoded
+                left = [len(row)]
+                for i in row:
+                    start = time.perf_counter()
+                    while not slots.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                    waits['read_wait_seconds'] += time.perf_counter() - start
+
+                    tile_x = windows[i][0][0] - offset[0]
+                    encode_depths.append(to_encode.qsize())
+                    to_encode.put((i, strip[:, :, tile_x:tile_x + windows[i][1][0]], strip, left))
+        except Exception as e:
+            to_write.put((None, e))
+        finally:
+            if encode_depths:
+                waits['encode_queue_max'] = max(encode_depths)
+                waits['encode_queue_mean'] = sum(encode_depths) / len(encode_depths)
+            for _ in range(threads):
+                to_encode.put(None)
+
+    def encoder():
+        while (item := to_encode.get()) is not None:
+            i, data, strip, left = item
+            if not stop.is_set():
+                try:
+                    result = record_tile(timed_render(img, tasks[i], data, cache, bands), tasks[i], stats)
+                except Exception as e:
+                    result = e
+                to_write.put((i, result))
+
+            with lock:
+                left[0] -= 1
+                if left[0] == 0:
+                    pool.release(strip)
+
+    workers = [threading.Thread(target=reader, daemon=True),
+               *[threading.Thread(target=encoder, daemon=True) for _ in range(threads)]]
+    for worker in workers:
+        worker.start()
+
+    # Tiles finish out of order, they wait here until the ones before them are done
+    finished = {}
+    write_depths = []
+    try:
+        for i in range(len(tasks)):
+            start = time.perf_counter()
+            while i not in finished:
+                j, result = to_write.get()
+                write_depths.append(to_write.qsize())
+                if j is None:
+                    raise result
+                finished[j] = result
+            waits['write_wait_seconds'] += time.perf_counter() - start
+
+            result = finished.pop(i)
+            if isinstance(result, Exception):
+                raise result
+            slots.release()
+
+            yield result
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+        if write_depths:
+            waits['write_queue_max'] = max(write_depths)
+            waits['write_queue_mean'] = sum(write_depths) / len(write_depths)
+
+
+# JFIF APP0 segment, so viewers know the copied TIFF JPEG data is YCbCr
+JFIF_APP0 = bytes.fromhex('ffe000104a46494600010100000100010000')
+
+
+def jpeg_block_size(img: osgeo.gdal.Dataset) -> list[int] | None:
+    """
+    The block size of a GeoTIFF whose blocks are each a JPEG image that could be used as a
+    tile as it is, i.e. JPEG compressed as YCbCr or greyscale. None for any other source.
+    """
+    if img.GetDriver().ShortName != 'GTiff' or img.RasterCount not in (1, 3):
+        return None
 
+    compression = img.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE')
+    if compression != 'YCbCr JPEG' and not (compression == 'JPEG' and img.RasterCount == 1):
+        return None
+
+    return img.GetRasterBand(1).GetBlockSize()
+
+
+def block_windows(img_size: list[int],
+                  block_size: list[int],
+                  border: int | tuple[int, int, int, int] = 0,
+                  exclude: list[str] = None) -> tuple[list[int], list[tuple]]:
+    """
+    Lay out the tiles on the source's own block grid, so every whole block is exactly one tile.
+    The left and top of the crop are moved out to the nearest block edge, and the tiles at the
+    right and bottom are cut short where the crop falls inside a block. Returns the same as tile_windows.
+    """
+    if exclude is None:
+        exclude = []
+    if isinstance(border, int):
+        border = (border, border, border, border)
+
+    x_edges = [*range(border[0] // block_size[0] * block_size[0], img_size[0] - border[2], block_size[0]),
+               img_size[0] - border[2]]
+    y_edges = [*range(border[1] // block_size[1] * block_size[1], img_size[1] - border[3], block_size[1]),
+               img_size[1] - border[3]]
+    tile_layout = [len(x_edges) - 1, len(y_edges) - 1]
+    logging.debug(f'Using source block layout {tile_layout} -> {block_size[0]}x{block_size[1]}')
+
+    windows = []
     for t_y in range(tile_layout[1]):
         for t_x in range(tile_layout[0]):
             tile = f'{t_y},{t_x}'
-            logging.debug(tile)
             if tile in exclude:
                 logging.debug(f"Excluding tile {tile}")
             else:
-                src_corner = (border + t_x * tile_sizes[0], border + t_y * tile_sizes[1])
-                src_size = [tile_sizes[0], tile_sizes[1]]
-                if src_corner[0] + tile_sizes[0] > img_size[0] - border:
-                    src_size[0] = int(tile_sizes[0])
+                windows.append((tile, t_x, t_y, (x_edges[t_x], y_edges[t_y]),
+                                [x_edges[t_x + 1] - x_edges[t_x], y_edges[t_y + 1] - y_edges[t_y]]))
+
+    return tile_layout, windows
+
+
+def jpeg_block(img: osgeo.gdal.Dataset, offset: tuple[int, int], size: list[int]) -> tuple[int, int] | None:
+    """
+    Find where the JPEG data for a window is in the source file, as (file offset, length), if
+    the window is exactly one whole block of a source where jpeg_block_size applies.
+    """
+    block_size = jpeg_block_size(img)
+    if block_size is None or list(size) != list(block_size) \
+            or offset[0] % block_size[0] or offset[1] % block_size[1] \
+            or offset[0] + size[0] > img.RasterXSize or offset[1] + size[1] > img.RasterYSize:
+        return None
+
+    band = img.GetRasterBand(1)
+    block_x, block_y = offset[0] // block_size[0], offset[1] // block_size[1]
+    start = band.GetMetadataItem(f'BLOCK_OFFSET_{block_x}_{block_y}', 'TIFF')
+    length = band.GetMetadataItem(f'BLOCK_SIZE_{block_x}_{block_y}', 'TIFF')
+    if not start or not length:
+        # Sparse block with no data in the file
+        return None
+
+    return int(start), int(length)
+
+
+def read_jpeg_block(img: osgeo.gdal.Dataset, block: tuple[int, int]) -> bytes | None:
+    """
+    Read a block found by jpeg_block and make it a standalone JPEG, merging in the quantisation
+    and Huffman tables the TIFF keeps separately. None if it can't be made into one.
+    """
+    f = gdal.VSIFOpenL(img.GetDescription(), 'rb')
+    gdal.VSIFSeekL(f, block[0], 0)
+    data = gdal.VSIFReadL(1, block[1], f)
+    gdal.VSIFCloseL(f)
 
-                if src_corner[1] + tile_sizes[1] > img_size[1] - border:
-                    src_size[1] = int(tile_sizes[1])
+    if data[:2] != b'\xff\xd8':
+        return None
 
-                outfile = f'{base}_{t_x:d}_{t_y:d}.jpg'
-                outpath = f'{directory}/{outfile}'
+    tables = img.GetRasterBand(1).GetMetadataItem('JPEGTABLES', 'TIFF')
+    if tables:
+        # The tables are an abbreviated stream of their own, drop its end and the block's start
+        tables = bytes.fromhex(tables)
+        if tables[-2:] == b'\xff\xd9':
+            data = tables[:-2] + data[2:]
+
+    if b'\xff\xdb' not in data:
+        # No quantisation tables, so it would not decode on its own
+        return None
+
+    if data[2:4] != b'\xff\xe0':
+        data = data[:2] + JFIF_APP0 + data[2:]
+
+    return data
+
+
+def copy_tile(img: osgeo.gdal.Dataset, args: tuple, block: tuple[int, int]) -> tuple[dict[str, int], bytes | None] | None:
+    """
+    Like render_tile, but the tile is the source's own JPEG data for the block, with no encoding.
+    The block is only decoded with min_coverage, to check it isn't blank. None if the block
+    can't be used as a tile.
+    """
+    filename, offset, size, quality, encoder, min_coverage, bounds = args
+    if min_coverage is not None:
+        data = read_window(img, offset, size, _buffers)
+        try:
+            if is_blank(img, data, min_coverage):
+                logging.debug(f'Skipping blank tile at {offset}')
+                return None, None
+        finally:
+            _buffers.release(data)
 
-                if src_corner[0] + src_size[0] > img_size[0]:
-                    logging.error('Pixel range outside image data!')
-                    logging.error(f'Image width {img_size[0]}, trying to get at x={src_corner[0] + src_size[0]}')
-                bounds = create_tile(img, outpath, src_corner, src_size, quality)
+    jpeg = read_jpeg_block(img, block)
+    if jpeg is None:
+        return None
+    if filename is None:
+        return bounds, jpeg
 
-                bob.write(f"""    <GroundOverlay>
+    with open(filename, 'wb') as f:
+        f.write(jpeg)
+    return bounds, None
+
+
+def render_tile(img: osgeo.gdal.Dataset,
+                args: tuple,
+                data: np.ndarray = None,
+                cache: TileCache = None,
+                bands: list[tuple[bool, float | None]] = None) -> tuple[dict[str, int], bytes | None]:
+    """
+    Create a tile from (filename, offset, size, quality, encoder, min_coverage, bounds) and return its bounds.
+    Without a filename the jpeg data is returned alongside the bounds instead of being written.
+    The bounds are None for a blank tile that was skipped.
+    """
+    filename, offset, size, quality, encoder, min_coverage, bounds = args
+    jpeg = encode_tile(img, offset, size, quality, data, encoder, cache, min_coverage, bands)
+    if jpeg is None:
+        return None, None
+    if filename is None:
+        return bounds, jpeg
+
+    with open(filename, 'wb') as f:
+        f.write(jpeg)
+    return bounds, None
+
+
+def timed_render(img: osgeo.gdal.Dataset,
+                 args: tuple,
+                 data: np.ndarray = None,
+                 cache: TileCache = None,
+                 bands: list[tuple[bool, float | None]] = None) -> tuple[tuple[dict[str, int], bytes | None], float, float, int]:
+    """
+    Run render_tile and also return the wall and CPU seconds it took and the size of the jpeg,
+    so the time spent in worker processes can be reported too.
+    """
+    start, cpu = time.perf_counter(), time.thread_time()
+    bounds, jpeg = render_tile(img, args, data, cache, bands)
+    seconds, cpu_seconds = time.perf_counter() - start, time.thread_time() - cpu
+
+    if bounds is None:
+        nbytes = 0
+    elif jpeg is None:
+        nbytes = os.path.getsize(args[0])
+    else:
+        nbytes = len(jpeg)
+    return (bounds, jpeg), seconds, cpu_seconds, nbytes
+
+
+def record_tile(timed: tuple, args: tuple, stats: Stats) -> tuple[dict[str, int], bytes | None]:
+    """
+    Add a timed_render result to the encode stage and the tile times, and return the tile.
+    """
+    result, seconds, cpu_seconds, nbytes = timed
+    stats.add('encode', seconds, cpu_seconds, nbytes, args[2][0] * args[2][1])
+    stats.tile(seconds)
+    return result
+
+
+def kml_document(name: str, order: int, overlays: list[tuple[str, str, dict]]) -> str:
+    """
+    Build the KML for a list of (name, href, bounds) ground overlays.
+    Bounds with a 'quad' of corners are placed with a gx:LatLonQuad rather than a LatLonBox.
+    """
+    doc = [f"""<?xml version="1.0" encoding="UTF-8"?>
+             <kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" 
+             xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
+               <Folder>
+                 <name>{name}</name>
+             """]
+
+    for outfile, href, bounds in overlays:
+        doc.append(f"""    <GroundOverlay>
                 <name>{outfile}</name>
                 <color>ffffffff</color>
                 <drawOrder>{order}</drawOrder>
                 <Icon>
-                    <href>{path}/{outfile}</href>
+                    <href>{href}</href>
                     <viewBoundScale>0.75</viewBoundScale>
                 </Icon>
-                <LatLonBox>""")
+""")
 
-                bob.write(f"""<north>{bounds['north']}</north>
+        if 'quad' in bounds:
+            coordinates = ' '.join(f'{lon},{lat}' for lon, lat in bounds['quad'])
+            doc.append(f"""                <gx:LatLonQuad>
+                    <coordinates>{coordinates}</coordinates>
+                </gx:LatLonQuad>
+            </GroundOverlay>
+    """)
+            continue
+
+        doc.append(f"""                <LatLonBox><north>{bounds['north']}</north>
                                 <south>{bounds['south']}</south>
                                 <east>{bounds['east']}</east>
                                 <west>{bounds['west']}</west>
                                 <rotation>0</rotation>
                 """)
-                bob.write("""        </LatLonBox>
+        doc.append("""        </LatLonBox>
             </GroundOverlay>
     """)
 
-    bob.write("""  </Folder>
+    doc.append("""  </Folder>
     </kml>
     """)
 
-    bob.close()
+    return ''.join(doc)
+
+
+def file_digest(path: str | Path) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_manifest(path: Path, header: dict, directory: Path) -> dict[str, dict]:
+    """
+    Read the tiles recorded by an earlier run with the same settings, keeping only those whose
+    jpeg is still on disk with the recorded checksum.
+    """
+    if not path.exists():
+        return {}
+
+    records = {}
+    with open(path) as f:
+        lines = f.readlines()
+
+    try:
+        if not lines or json.loads(lines[0]) != header:
+            logging.info(f'Manifest {path} is for different settings, starting again')
+            return {}
+        for line in lines[1:]:
+            record = json.loads(line)
+            records[record['tile']] = record
+    except json.JSONDecodeError:
+        # A run killed mid-write leaves a truncated last line, everything before it is still good
+        logging.debug(f'Ignoring truncated manifest line in {path}')
+
+    done = {}
+    for tile, record in records.items():
+        if record['file'] is None:
+            # Blank tile that was skipped
+            done[tile] = record
+            continue
+        jpeg = directory / record['file']
+        if jpeg.exists() and file_digest(jpeg) == record['sha256']:
+            done[tile] = record
+        else:
+            logging.debug(f'Tile {tile} is missing or changed, creating it again')
+
+    return done
+
+
+# Dataset handle and tile cache set up once per worker process by _init_worker
+_worker_img = None
+_worker_cache = None
+
+
+def _init_worker(source: str, cache: TileCache = None) -> None:
+    global _worker_img, _worker_cache
+    _worker_img = gdal.Open(source)
+    _worker_cache = cache
+
+
+def _create_tile_worker(args: tuple) -> tuple:
+    """
+    Process pool entry point, create a tile from the worker's own dataset handle.
+    Returns the same as timed_render.
+    """
+    return timed_render(_worker_img, args, cache=_worker_cache)
+
+
+def _shared_tile_worker(args: tuple) -> tuple:
+    """
+    Process pool entry point, create a tile from a strip the coordinator has already read into
+    shared memory, given as (name, shape, dtype, x, width, render_tile args).
+    """
+    name, shape, dtype, x, width, tile_args = args
+    shm = shared_memory.SharedMemory(name=name)
+    strip = np.ndarray(shape, dtype, buffer=shm.buf)
+    try:
+        return timed_render(_worker_img, tile_args, strip[:, :, x:x + width], _worker_cache)
+    finally:
+        # The buffer can only be closed once nothing is looking at it
+        del strip
+        shm.close()
+
+
+def shared_strip_tiles(img: osgeo.gdal.Dataset,
+                       tasks: list[tuple],
+                       pool: ProcessPoolExecutor,
+                       depth: int = 2,
+                       stats: Stats = None) -> Iterator[tuple[dict[str, int], bytes | None]]:
+    """
+    Run render_tile for a list of args in a pool started with _init_worker, decoding each row
+    of tiles just once: the strip is read here into shared memory and the workers encode their
+    tiles from it without copying. The next strip is read while the workers encode the last,
+    with up to depth strips in memory. Results are yielded in order, and the read and encode
+    stages recorded in stats.
+    """
+    if stats is None:
+        stats = Stats()
+
+    windows = [(args[1], args[2]) for args in tasks]
+    if not windows:
+        return
+
+    strip_width = max(offset[0] + size[0] for offset, size in windows) - min(offset[0] for offset, _ in windows)
+    cache_strips(img, strip_width, max(size[1] for _, size in windows))
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(img.GetRasterBand(1).DataType))
+
+    def finish(shm, futures):
+        try:
+            for i, future in futures:
+                yield record_tile(future.result(), tasks[i], stats)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    in_flight = deque()
+    try:
+        for row, offset, size in tile_rows(windows):
+            shape = (img.RasterCount, size[1], size[0])
+            shm = shared_memory.SharedMemory(create=True, size=max(1, math.prod(shape) * dtype.itemsize))
+            in_flight.append((shm, []))
+
+            with stats.timed('read', shm.size, size[0] * size[1]):
+                strip = np.ndarray(shape, dtype, buffer=shm.buf)
+                img.ReadAsArray(offset[0], offset[1], size[0], size[1],
+                                buf_obj=strip if img.RasterCount > 1 else strip[0])
+                del strip
+
+            for i in row:
+                in_flight[-1][1].append((i, pool.submit(_shared_tile_worker, (
+                    shm.name, shape, dtype.str, windows[i][0][0] - offset[0], windows[i][1][0], tasks[i]))))
+
+            while len(in_flight) >= depth:
+                yield from finish(*in_flight.popleft())
+
+        while in_flight:
+            yield from finish(*in_flight.popleft())
+    finally:
+        for shm, futures in in_flight:
+            for _, future in futures:
+                future.cancel()
+            # Workers still encoding keep their own mapping, so the strip can go now
+            shm.close()
+            shm.unlink()
+
+
+def source_authority(img: osgeo.gdal.Dataset) -> tuple[str, str]:
+    # https://gdal.org/user/raster_data_model.html#raster-data-model
+    srs = osr.SpatialReference(wkt=img.GetProjection())
+    return srs.GetAttrValue('AUTHORITY', 0), srs.GetAttrValue('AUTHORITY', 1)
+
+
+def open_source(source: str | Path, warp: bool = False) -> osgeo.gdal.Dataset:
+    """
+    Open a georeferenced image, checking it is in a CRS that can be tiled,
+    or that it can be warped to one if warp is set.
+    """
+    img = gdal.Open(str(source))
+    if img is None:
+        raise (AttributeError('Not a valid georeferenced image:', source))
+    logging.info(img.GetProjection())
+
+    authority = source_authority(img)
+    logging.debug(authority)
+
+    if authority != ('EPSG', '4326') and not (warp and img.GetProjection()):
+        errmsg = f'Input file is not in standard CRS. Should be EPSG 4326 but is {authority[0]} {authority[1]}'
+        logging.error(errmsg)
+        raise NotImplementedError(errmsg)
+
+    return img
+
+
+def tile_windows(img_size: list[int],
+                 tile_size: int = 1024,
+                 border: int | tuple[int, int, int, int] = 0,
+                 pixel_budget: bool = False,
+                 exclude: list[str] = None) -> tuple[list[int], list[tuple]]:
+    """
+    Lay out the tiles for an image. Returns the [columns, rows] layout and a
+    (tile, t_x, t_y, offset, size) window for every tile not in exclude, in grid order.
+    The border is cropped from every side, or can be given per side as (left, top, right, bottom).
+    """
+    if exclude is None:
+        exclude = []
+    if isinstance(border, int):
+        border = (border, border, border, border)
+
+    cropped_size = [img_size[0] - border[0] - border[2], img_size[1] - border[1] - border[3]]
+    tile_layout = tiles(cropped_size, tile_size, max_pixels=tile_size ** 2 if pixel_budget else None)
+
+    x_edges, y_edges = tile_edges(cropped_size[0], tile_layout[0]), tile_edges(cropped_size[1], tile_layout[1])
+    logging.debug(f'Using tile layout {tile_layout} -> {x_edges[1]}x{y_edges[1]}')
+
+    windows = []
+    for t_y in range(tile_layout[1]):
+        for t_x in range(tile_layout[0]):
+            tile = f'{t_y},{t_x}'
+            logging.debug(tile)
+            if tile in exclude:
+                logging.debug(f"Excluding tile {tile}")
+            else:
+                src_corner = (border[0] + x_edges[t_x], border[1] + y_edges[t_y])
+                src_size = [x_edges[t_x + 1] - x_edges[t_x], y_edges[t_y + 1] - y_edges[t_y]]
+                windows.append((tile, t_x, t_y, src_corner, src_size))
+
+    return tile_layout, windows
+
+
+def fit_scale(canvas_shape: list[int], max_tiles: int, tile_size: int = 1024, max_pixels: int = None) -> float:
+    """
+    Find the largest scale, up to 1, at which the canvas needs no more than max_tiles tiles.
+    """
+    def count(scale: float) -> int:
+        layout = tiles([max(1, round(x * scale)) for x in canvas_shape], tile_size, max_pixels)
+        return layout[0] * layout[1]
+
+    if count(1.0) <= max_tiles:
+        return 1.0
+
+    low, high = 0.0, 1.0
+    for _ in range(32):
+        mid = (low + high) / 2
+        if count(mid) <= max_tiles:
+            low = mid
+        else:
+            high = mid
+
+    return low
+
+
+def prepare_source(img: osgeo.gdal.Dataset,
+                   border: int | tuple[int, int, int, int] | str = 0,
+                   tile_size: int = 1024,
+                   pixel_budget: bool = False,
+                   scale: float = None,
+                   max_tiles: int = None,
+                   resampling: str = 'average',
+                   warp: bool = False) -> tuple[osgeo.gdal.Dataset, int | tuple[int, int, int, int]]:
+    """
+    Work out the border, detecting the collar if it is 'auto', and if the image is to be scaled
+    down (by scale, or as far as needed to fit in max_tiles tiles) crop and resample it through
+    an in-memory VRT. Tiles are then read from the VRT at the lower resolution, which GDAL serves
+    from the source's overviews where it has them. Returns the dataset to tile and its border.
+
+    With warp, a source not in EPSG:4326 (or rotated) is reprojected through a warped VRT, so each tile's
+    window is warped from the source as it is read and no warped copy is ever written.
+    """
+    source = None
+    geotransform = img.GetGeoTransform()
+    if warp and (source_authority(img) != ('EPSG', '4326') or geotransform[2] != 0 or geotransform[4] != 0):
+        logging.debug('Warping to EPSG:4326 as tiles are read')
+        source, img = img, gdal.Warp('', img, format='VRT', dstSRS='EPSG:4326', resampleAlg=resampling)
+
+    if border == 'auto':
+        border = detect_collar(img)
+    if isinstance(border, int):
+        border = (border, border, border, border)
+
+    cropped_size = [img.RasterXSize - border[0] - border[2], img.RasterYSize - border[1] - border[3]]
+    if max_tiles is not None:
+        fitted = fit_scale(cropped_size, max_tiles, tile_size, max_pixels=tile_size ** 2 if pixel_budget else None)
+        scale = fitted if scale is None else min(scale, fitted)
+
+    if scale is None or scale == 1:
+        return img, border
+
+    size = [max(1, round(x * scale)) for x in cropped_size]
+    logging.debug(f'Scaling {cropped_size} to {size} with {resampling} resampling')
+    if source is not None:
+        # Crop and scale in the warp itself, so the VRT only refers to the source file
+        geotransform = img.GetGeoTransform()
+        west, north = transform(border[0], border[1], geotransform)
+        east, south = transform(border[0] + cropped_size[0], border[1] + cropped_size[1], geotransform)
+        vrt = gdal.Warp('', source, format='VRT', dstSRS='EPSG:4326',
+                        outputBounds=(west, south, east, north),
+                        width=size[0], height=size[1],
+                        resampleAlg=resampling)
+    else:
+        vrt = gdal.Translate('', img, format='VRT',
+                             srcWin=[border[0], border[1], *cropped_size],
+                             width=size[0], height=size[1],
+                             resampleAlg=resampling)
+
+    return vrt, 0
+
+
+def tile_quads(img: osgeo.gdal.Dataset, windows: list[tuple], tolerance: float = 1.0) -> dict[str, dict] | None:
+    """
+    Place each tile window by the lon/lat of its four corners, as bounds with a 'quad' of
+    (lower left, lower right, upper right, upper left) for a gx:LatLonQuad. The edge midpoints
+    and centre are transformed too, and if any of them is further than tolerance pixels from
+    where the corners put it, None is returned as the tiles need warping instead.
+    """
+    if not windows:
+        return {}
+
+    # Corners, then edge midpoints and centre, as fractions across and down each tile
+    u = np.array([0, 1, 1, 0, 0.5, 1, 0.5, 0, 0.5])
+    v = np.array([1, 1, 0, 0, 0, 0.5, 1, 0.5, 0.5])
+
+    offsets = np.array([offset for *_, offset, _ in windows], dtype=float)
+    sizes = np.array([size for *_, size in windows], dtype=float)
+    px = offsets[:, :1] + u * sizes[:, :1]
+    py = offsets[:, 1:] + v * sizes[:, 1:]
+
+    geotransform = img.GetGeoTransform()
+    x = geotransform[0] + px * geotransform[1] + py * geotransform[2]
+    y = geotransform[3] + px * geotransform[4] + py * geotransform[5]
+
+    if source_authority(img) == ('EPSG', '4326'):
+        lon, lat = x, y
+    else:
+        src_srs = osr.SpatialReference(wkt=img.GetProjection())
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromEPSG(4326)
+        for srs in (src_srs, dst_srs):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        ct = osr.CoordinateTransformation(src_srs, dst_srs)
+
+        # All the points of all the tiles in one call
+        points = np.array(ct.TransformPoints(np.column_stack([x.ravel(), y.ravel()]).tolist()))
+        lon, lat = points[:, 0].reshape(x.shape), points[:, 1].reshape(y.shape)
+
+    def bilinear(c: np.ndarray) -> np.ndarray:
+        ll, lr, ur, ul = c[:, 0:1], c[:, 1:2], c[:, 2:3], c[:, 3:4]
+        cu, cv = u[4:], v[4:]
+        return (1 - cu) * (1 - cv) * ul + cu * (1 - cv) * ur + (1 - cu) * cv * ll + cu * cv * lr
+
+    error = np.hypot(bilinear(lon) - lon[:, 4:], bilinear(lat) - lat[:, 4:]).max(axis=1)
+    pixel = np.minimum(np.hypot(lon[:, 2] - lon[:, 3], lat[:, 2] - lat[:, 3]) / sizes[:, 0],
+                       np.hypot(lon[:, 3] - lon[:, 0], lat[:, 3] - lat[:, 0]) / sizes[:, 1])
+    error = error / pixel
+    logging.debug(f'Largest LatLonQuad error {error.max():.3f} pixels')
+    if error.max() > tolerance:
+        return None
+
+    return {
+        tile: {'quad': [[float(lon[i, j]), float(lat[i, j])] for j in range(4)]}
+        for i, (tile, *_) in enumerate(windows)
+    }
+
+
+def layout_tiles(source: str | Path,
+                 tile_size: int = 1024,
+                 border: int | tuple[int, int, int, int] | str = 0,
+                 exclude: list[str] = None,
+                 pixel_budget: bool = False,
+                 scale: float = None,
+                 max_tiles: int = None,
+                 resampling: str = 'average',
+                 warp: bool = False,
+                 quad: bool = False,
+                 quad_tolerance: float = 1.0,
+                 passthrough: bool = False) -> tuple[osgeo.gdal.Dataset, str, list[int], list[tuple], dict]:
+    """
+    Open the source and lay out its tiles. Returns the dataset to read the tiles from, the name
+    a worker process can open it by, the [columns, rows] layout, the tile windows (see tile_windows)
+    and the bounds of each tile.
+
+    With quad, a rotated or projected source is tiled on its own pixel grid with each tile placed
+    by its corners (see tile_quads), as long as they are within quad_tolerance pixels, and is
+    warped as with warp otherwise.
+
+    With passthrough, a JPEG compressed GeoTIFF with blocks no bigger than the tiles is laid out
+    on its own block grid (see block_windows), so the blocks can be copied as tiles, as long as
+    that takes no more tiles than the usual layout.
+    """
+    source = Path(source)
+    original = open_source(source, warp or quad)
+
+    geotransform = original.GetGeoTransform()
+    rotated = geotransform[2] != 0 or geotransform[4] != 0
+    if quad and (rotated or source_authority(original) != ('EPSG', '4326')):
+        img, crop = prepare_source(original, border, tile_size, pixel_budget, scale, max_tiles, resampling)
+        tile_layout, windows = tile_windows([img.RasterXSize, img.RasterYSize], tile_size, crop, pixel_budget, exclude)
+        bounds = tile_quads(img, windows, quad_tolerance)
+        if bounds is not None:
+            src_name = str(source) if img is original else img.GetMetadata('xml:VRT')[0]
+            return img, src_name, tile_layout, windows, bounds
+        logging.info(f'Tiles are out by more than {quad_tolerance} pixels at their corners, warping instead')
+        warp = True
+
+    img, crop = prepare_source(original, border, tile_size, pixel_budget, scale, max_tiles, resampling, warp)
+    # Worker processes open a scaled or warped VRT from its XML rather than the source
+    src_name = str(source) if img is original else img.GetMetadata('xml:VRT')[0]
+
+    img_size = [img.RasterXSize, img.RasterYSize]
+    tile_layout, windows = tile_windows(img_size, tile_size, crop, pixel_budget, exclude)
+
+    block_size = jpeg_block_size(img) if passthrough and img is original else None
+    max_side = tile_size if not pixel_budget else JPEG_MAX_SIDE
+    if block_size and max(block_size) <= max_side and block_size[0] * block_size[1] <= tile_size ** 2:
+        # Small blocks or strips would mean many more tiles than devices can show, so only
+        # line the tiles up with the blocks if that doesn't add any
+        block_layout, block_tiles = block_windows(img_size, block_size, crop, exclude)
+        if block_layout[0] * block_layout[1] <= tile_layout[0] * tile_layout[1]:
+            tile_layout, windows = block_layout, block_tiles
+        else:
+            logging.info(f'Source blocks of {block_size[0]}x{block_size[1]} would make '
+                         f'{block_layout[0] * block_layout[1]} tiles instead of {tile_layout[0] * tile_layout[1]}, '
+                         f'encoding the tiles')
+    elif passthrough:
+        logging.info('Source blocks are not JPEG images that fit in a tile, encoding the tiles')
+    geotransform = img.GetGeoTransform()
+    bounds = {tile: tile_bounds(geotransform, offset, size) for tile, _, _, offset, size in windows}
+
+    return img, src_name, tile_layout, windows, bounds
+
+
+def plan_kml(source: str | Path,
+             tile_size: int = 1024,
+             border: int | tuple[int, int, int, int] | str = 0,
+             exclude: list[str] = None,
+             quality: int = 75,
+             jobs: int = 1,
+             encoder: str = 'gdal',
+             pixel_budget: bool = False,
+             scale: float = None,
+             max_tiles: int = None,
+             resampling: str = 'average',
+             warp: bool = False,
+             quad: bool = False,
+             quad_tolerance: float = 1.0,
+             passthrough: bool = False,
+             queue_depth: int = 8,
+             shared_strips: bool = False,
+             sample: int = 64) -> dict:
+    """
+    Work out what create_kml would do with the same settings without tiling anything.
+    Only the metadata and a few sample x sample patches of pixels are read, the patches
+    being encoded to estimate the size of the jpegs.
+    """
+    source = Path(source)
+    img, _, tile_layout, windows, bounds = layout_tiles(source, tile_size, border, exclude, pixel_budget, scale,
+                                                        max_tiles, resampling, warp, quad, quad_tolerance,
+                                                        passthrough)
+    img_size = [img.RasterXSize, img.RasterYSize]
+
+    # Encode a 3x3 grid of patches from the middle of the tiles to get the bytes per pixel
+    bytes_per_pixel = 0
+    if windows:
+        pool = BufferPool()
+        patches = []
+        for i in range(3):
+            for j in range(3):
+                _, _, _, offset, size = windows[(len(windows) * (3 * i + j)) // 9]
+                patch = [min(sample, size[0]), min(sample, size[1])]
+                corner = (offset[0] + (size[0] - patch[0]) // 2, offset[1] + (size[1] - patch[1]) // 2)
+                patches.append(read_window(img, corner, patch, pool))
+        height = min(patch.shape[1] for patch in patches)
+        strip = np.concatenate([patch[:, :height] for patch in patches], axis=2)
+        bytes_per_pixel = len(ENCODERS[encoder](strip, quality)) / (strip.shape[1] * strip.shape[2])
+
+    pixels = sum(size[0] * size[1] for _, _, _, _, size in windows)
+
+    # Serial runs hold the strips of the tiles in the pipeline plus the blocks a strip touches,
+    # each process holds a tile of each, or with shared strips there are two strips to share
+    band = img.GetRasterBand(1)
+    pixel_bytes = gdal.GetDataTypeSize(band.DataType) // 8 * img.RasterCount
+    block_width, block_height = band.GetBlockSize()
+    max_width = max((size[0] for *_, size in windows), default=0)
+    max_height = max((size[1] for *_, size in windows), default=0)
+    strip_width = sum(size[0] for _, _, t_y, _, size in windows if t_y == windows[0][2]) if windows else 0
+    strip_blocks = (math.ceil(strip_width / block_width) + 1) * block_width * \
+        (math.ceil(max_height / block_height) + 1) * block_height
+    if jobs > 1 and shared_strips:
+        buffers = 2 * strip_width * max_height + jobs * max_width * max_height
+        blocks = strip_blocks
+    elif jobs > 1:
+        buffers = jobs * max_width * max_height
+        blocks = jobs * (math.ceil(max_width / block_width) + 1) * block_width * \
+            (math.ceil(max_height / block_height) + 1) * block_height
+    else:
+        strips = min(tile_layout[1], math.ceil(queue_depth / tile_layout[0]) + 1)
+        buffers = strips * strip_width * max_height
+        blocks = strip_blocks
+
+    return {
+        'source': str(source),
+        'size': img_size,
+        'bands': img.RasterCount,
+        'block_size': [block_width, block_height],
+        'layout': tile_layout,
+        'tile_count': len(windows),
+        'tiles': [{
+            'tile': tile,
+            'window': [*offset, *size],
+            'bounds': bounds[tile],
+        } for tile, _, _, offset, size in windows],
+        'estimated_bytes': int(bytes_per_pixel * pixels),
+        'estimated_peak_memory': (buffers + blocks) * pixel_bytes,
+    }
+
+
+def format_plan(plan: dict) -> str:
+    lines = [
+        f"{plan['source']}: {plan['size'][0]}x{plan['size'][1]}, {plan['bands']} bands, "
+        f"blocks {plan['block_size'][0]}x{plan['block_size'][1]}",
+        f"Layout {plan['layout'][0]}x{plan['layout'][1]}, {plan['tile_count']} tiles, "
+        f"~{plan['estimated_bytes'] / 1024 ** 2:.1f} MB of jpegs, "
+        f"~{plan['estimated_peak_memory'] / 1024 ** 2:.1f} MB peak memory",
+    ]
+    for tile in plan['tiles']:
+        x, y, width, height = tile['window']
+        bounds = tile['bounds']
+        if 'quad' in bounds:
+            place = ' '.join(f'{lon:.6f},{lat:.6f}' for lon, lat in bounds['quad'])
+        else:
+            place = f"N {bounds['north']:.6f} S {bounds['south']:.6f} E {bounds['east']:.6f} W {bounds['west']:.6f}"
+        lines.append(f"  {tile['tile']:>7}  {width}x{height}+{x}+{y}  {place}")
+    return '\n'.join(lines)
+
+
+def create_kml(source: str | Path,
+               filename: str | Path,
+               directory: str | Path | None,
+               tile_size: int = 1024,
+               border: int | tuple[int, int, int, int] | str = 0,
+               name: str = None,
+               order: int = 20,
+               exclude: list[str] = None,
+               quality: int = 75,
+               jobs: int = 1,
+               encoder: str = 'gdal',
+               cache: TileCache = None,
+               resume: bool = False,
+               pixel_budget: bool = False,
+               min_coverage: float = None,
+               scale: float = None,
+               max_tiles: int = None,
+               resampling: str = 'average',
+               warp: bool = False,
+               quad: bool = False,
+               quad_tolerance: float = 1.0,
+               passthrough: bool = False,
+               threads: int = 1,
+               queue_depth: int = 8,
+               shared_strips: bool = False,
+               stats: Stats = None) -> None:
+    """
+    Create a kml file and associated images for the given georeferenced image.
+    With jobs > 1 the tiles are encoded in a pool of worker processes, each with its own dataset handle,
+    or with shared_strips each row of tiles is read once and shared with them (see shared_strip_tiles).
+    Otherwise reading, encoding with threads encoder threads and writing overlap in a pipeline
+    with up to queue_depth tiles in it (see pipeline_tiles).
+    If filename ends in .kmz the tiles are encoded in memory and written straight into the archive,
+    and directory is not used.
+    The jpeg encoder is one of ENCODERS. With a cache, tiles whose pixels and settings
+    have been encoded before are taken from it instead of being encoded again.
+
+    The border is cropped from every side, or can be given per side as (left, top, right, bottom),
+    or as 'auto' to detect the collar around the map with detect_collar.
+
+    With pixel_budget tiles may be any shape with no more than tile_size squared pixels,
+    rather than at most tile_size on each side.
+
+    The image can be scaled down before tiling, either by scale or as far as needed to fit in
+    max_tiles tiles, using one of GDAL's resampling algorithms.
+    With warp, a source in another CRS is reprojected to EPSG:4326 tile by tile as it is read.
+    With quad, a rotated or projected source is only warped if placing each tile by its corners
+    with a gx:LatLonQuad would be out by more than quad_tolerance pixels.
+    With passthrough, the blocks of a JPEG compressed GeoTIFF are copied into the tiles as they are,
+    without decoding and encoding them again, wherever the tiles can line up with them.
+
+    With min_coverage, tiles that are a single colour or have no more than that fraction of
+    pixels with data are left out.
+
+    Finished tiles are recorded in a manifest next to a .kml, and with resume the tiles it lists
+    that are still intact are kept and only the rest are created.
+
+    The time, bytes and pixels of each stage and the time taken by each tile are recorded in stats.
+    """
+    if stats is None:
+        stats = Stats()
+
+    source, filename = Path(source), Path(filename)
+    kmz = filename.suffix.lower() == '.kmz'
+    if kmz:
+        if resume:
+            raise ValueError('Only .kml output can be resumed, a .kmz is written in one go')
+        path = Path('files')
+    else:
+        directory = Path(directory)
+        path = directory.relative_to(filename.parent)
+
+    # Opening includes checking the CRS and setting up any warping or scaling
+    with stats.timed('open'):
+        img, src_name, tile_layout, windows, bounds = layout_tiles(source, tile_size, border, exclude, pixel_budget,
+                                                                   scale, max_tiles, resampling, warp, quad,
+                                                                   quad_tolerance, passthrough)
+    stats.values['pixels'] = sum(size[0] * size[1] for *_, size in windows)
+
+    img_size = [img.RasterXSize, img.RasterYSize]
+    logging.debug(f'Image size: {img_size}')
+
+    base, ext = source.stem, source.suffix
+
+    if not name:
+        name = base
+
+    # Work out the tiles first so they can be created in any order
+    tasks = []
+    for tile, t_x, t_y, src_corner, src_size in windows:
+        outfile = f'{base}_{t_x:d}_{t_y:d}.jpg'
+        outpath = None if kmz else f'{directory}/{outfile}'
+        tasks.append((tile, outfile, (outpath, src_corner, src_size, quality, encoder, min_coverage, bounds[tile])))
+
+    done = {}
+    if not kmz:
+        manifest_path = filename.with_name(f'{filename.name}.manifest')
+        stat = source.stat()
+        header = json.loads(json.dumps({
+            'source': str(source.resolve()),
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime,
+            'tile_size': tile_size,
+            'pixel_budget': pixel_budget,
+            'border': border,
+            'quality': quality,
+            'encoder': encoder,
+            'min_coverage': min_coverage,
+            'scale': scale,
+            'max_tiles': max_tiles,
+            'resampling': resampling,
+            'warp': warp,
+            'quad': quad,
+            'passthrough': passthrough,
+            'size': img_size,
+            'layout': tile_layout,
+        }))
+        if resume:
+            done = load_manifest(manifest_path, header, directory)
+            logging.info(f'Resuming with {len(done)} of {len(tasks)} tiles already done')
+
+        # Start the manifest afresh with just the tiles still good, which also drops any truncated line
+        manifest = open(manifest_path, 'w')
+        for record in [header, *done.values()]:
+            manifest.write(json.dumps(record) + '\n')
+        manifest.flush()
+
+    pending = [task for task in tasks if task[0] not in done]
+
+    # Tiles that are exactly one of the source's JPEG blocks are copied, the rest are encoded
+    blocks = {}
+    if passthrough:
+        for tile, _, args in pending:
+            block = jpeg_block(img, args[1], args[2])
+            if block is not None:
+                blocks[tile] = block
+        logging.debug(f'Copying {len(blocks)} of {len(pending)} tiles from the source JPEG blocks')
+
+    def copy(args, block):
+        with stats.timed('copy', pixels=args[2][0] * args[2][1]) as counts:
+            result = copy_tile(img, args, block)
+            if result is not None and result[0] is not None:
+                counts['bytes'] = len(result[1]) if result[1] is not None else os.path.getsize(args[0])
+        if result is None:
+            # Not a block that can be used, so it is encoded instead
+            return record_tile(timed_render(img, args, cache=cache), args, stats)
+        return result
+
+    # Copied lazily so the blocks aren't all held at once
+    copied = ((task, copy(task[2], blocks[task[0]])) for task in pending if task[0] in blocks)
+    encoded = [task for task in pending if task[0] not in blocks]
+
+    if kmz:
+        # Built under a temporary name, so a failed run doesn't replace a good archive with a broken one
+        archive_tmp = filename.with_name(f'{filename.name}.tmp')
+        archive = zipfile.ZipFile(archive_tmp, 'w', zipfile.ZIP_DEFLATED)
+
+    pool = None
+    if jobs > 1:
+        # Results come back in submission order, so the KML is the same regardless of which tile finishes first
+        logging.debug(f'Creating {len(encoded)} tiles with {jobs} processes')
+        pool = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(src_name, cache))
+        if shared_strips:
+            results = shared_strip_tiles(img, [args for _, _, args in encoded], pool, stats=stats)
+        else:
+            timed = pool.map(_create_tile_worker, [args for _, _, args in encoded])
+            results = (record_tile(result, args, stats) for (_, _, args), result in zip(encoded, timed))
+    else:
+        logging.debug(f'Creating {len(encoded)} tiles with {threads} encoder threads')
+        results = pipeline_tiles(img, [args for _, _, args in encoded], cache, threads, queue_depth, stats)
+
+    all_bounds = {tile: record['bounds'] for tile, record in done.items()}
+    try:
+        for (tile, outfile, args), (bounds, data) in chain(copied, zip(encoded, results)):
+            all_bounds[tile] = bounds
+            if kmz:
+                # Each tile goes from memory into the archive without touching the disk
+                if bounds is not None:
+                    with stats.timed('write', len(data)):
+                        archive.writestr(f'{path}/{outfile}', data, zipfile.ZIP_STORED)
+            else:
+                # Skipped blank tiles are recorded too, so resuming doesn't look at them again
+                record = {
+                    'tile': tile,
+                    'window': [*args[1], *args[2]],
+                    'bounds': bounds,
+                    'file': outfile if bounds is not None else None,
+                    'sha256': file_digest(args[0]) if bounds is not None else None,
+                }
+                with stats.timed('write'):
+                    manifest.write(json.dumps(record) + '\n')
+                    manifest.flush()
+
+        overlays = [(outfile, f'{path}/{outfile}', all_bounds[tile])
+                    for tile, outfile, _ in tasks if all_bounds[tile] is not None]
+        kml = kml_document(name, order, overlays)
+        if kmz:
+            with stats.timed('kml', len(kml)):
+                archive.writestr('doc.kml', kml)
+    except BaseException:
+        # Drop the tiles not started yet rather than encoding them all before the error is seen
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if kmz:
+            archive.close()
+            archive_tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        results.close()
+        if pool is not None:
+            pool.shutdown()
+        elif 'pipeline' in stats.values:
+            # Not there if every tile was already done or copied, so the pipeline never started
+            logging.debug('Pipeline: ' + ', '.join(f'{key} {value:.2f}' if isinstance(value, float) else
+                                                   f'{key} {value}'
+                                                   for key, value in stats.values['pipeline'].items()))
+        if kmz:
+            archive.close()
+        else:
+            manifest.close()
+
+    if kmz:
+        os.replace(archive_tmp, filename)
+    else:
+        # Only replace the KML once it is complete, so a killed run never leaves a broken one behind
+        tmp = filename.with_name(f'{filename.name}.tmp')
+        with stats.timed('kml', len(kml)):
+            with open(tmp, 'w') as bob:
+                bob.write(kml)
+            os.replace(tmp, filename)
+
+
+def load_exclude(source: str | Path) -> list[str]:
+    """
+    Read the tiles to leave out from the .exclude file next to the source, if there is one.
+    """
+    exclude_file = Path(source).with_suffix('.exclude')
+    exclude = []
+    if exclude_file.exists():
+        logging.debug(f"Using exclude file {exclude_file}")
+        for line in open(exclude_file):
+            exclude.append(line.rstrip())
+        logging.debug(exclude)
+    return exclude
+
+
+def find_sources(pattern: str | Path) -> list[Path]:
+    """
+    Expand a directory (all .tif/.tiff files in it) or a glob pattern to a list of source files.
+    """
+    if Path(pattern).is_dir():
+        return sorted(p for p in Path(pattern).iterdir() if p.suffix.lower() in ('.tif', '.tiff'))
+    return sorted(Path(p) for p in glob.glob(str(pattern)))
+
+
+def _batch_worker(source: Path, filename: Path, directory: Path | None, options: dict) -> dict:
+    """
+    Process pool entry point for batch_kml, converts one file and reports how it went.
+    """
+    start = time.perf_counter()
+    try:
+        if directory is not None:
+            directory.mkdir(exist_ok=True)
+        create_kml(source, filename, directory, exclude=load_exclude(source), **options)
+    except Exception as e:
+        logging.exception(f'Failed to convert {source}')
+        return {'source': str(source), 'error': str(e), 'seconds': time.perf_counter() - start}
+    return {'source': str(source), 'output': str(filename), 'seconds': time.perf_counter() - start}
+
+
+def batch_kml(sources: list[str | Path],
+              output: str | Path,
+              jobs: int = 1,
+              kmz: bool = False,
+              **options) -> list[dict]:
+    """
+    Convert many files into the output directory with a pool of jobs processes, each converting
+    one file at a time. The biggest images are started first so they don't hold up the end of the run.
+    Other options are passed on to create_kml. Returns a report for each file in the order they finished.
+
+    Raises ValueError if two sources would be written to the same output, or for resume with kmz.
+    """
+    if kmz and options.get('resume'):
+        raise ValueError('Only .kml output can be resumed, a .kmz is written in one go')
+
+    # The outputs are named after the sources, so two with the same name would overwrite each other
+    stems = {}
+    for source in map(Path, sources):
+        stems.setdefault(source.stem, []).append(str(source))
+    clashes = [names for names in stems.values() if len(names) > 1]
+    if clashes:
+        raise ValueError('Sources would be written to the same output: ' +
+                         '; '.join(', '.join(names) for names in clashes))
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    # Only the metadata is read here, so sizing up the whole batch is cheap
+    sized = []
+    for source in map(Path, sources):
+        img = gdal.Open(str(source))
+        pixels = img.RasterXSize * img.RasterYSize if img is not None else 0
+        sized.append((pixels, source))
+        img = None
+    sized.sort(key=lambda x: x[0], reverse=True)
+
+    start = time.perf_counter()
+    reports = []
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = {}
+        for pixels, source in sized:
+            if kmz:
+                filename, directory = output / f'{source.stem}.kmz', None
+            else:
+                filename, directory = output / f'{source.stem}.kml', output / f'{source.stem}.files'
+            futures[pool.submit(_batch_worker, source, filename, directory, options)] = pixels
+
+        for future in as_completed(futures):
+            report = future.result()
+            report['megapixels'] = futures[future] / 1e6
+            report['megapixels_per_second'] = report['megapixels'] / report['seconds'] if report['seconds'] else 0
+            if 'error' in report:
+                logging.error(f"{report['source']}: {report['error']}")
+            else:
+                logging.info(f"{report['source']}: {report['megapixels']:.1f} MP in {report['seconds']:.1f}s "
+                             f"({report['megapixels_per_second']:.1f} MP/s)")
+            reports.append(report)
+
+    elapsed = time.perf_counter() - start
+    megapixels = sum(report['megapixels'] for report in reports if 'error' not in report)
+    logging.info(f'Converted {len(reports)} files, {megapixels:.1f} MP in {elapsed:.1f}s '
+                 f'({megapixels / elapsed if elapsed else 0:.1f} MP/s)')
+
+    return reports
 
 
 if __name__ == '__main__':
@@ -203,45 +1747,183 @@ if __name__ == '__main__':
         description='Convert a georeferenced TIFF file to KML file')
 
     parser.add_argument('src_file', metavar='src_file', type=str, help='source file')
-    parser.add_argument('dst_file', metavar='dst_file', type=str, help='destination file')
+    parser.add_argument('dst_file', metavar='dst_file', type=str, nargs='?',
+                        help='destination file (.kml or .kmz), not needed with --plan')
 
     parser.add_argument('-d', '--dir', dest='directory', help='Where to create jpeg tiles')
-    parser.add_argument('-c', '--crop', default=0, dest='border', type=int, help='Crop border')
+    parser.add_argument('-c', '--crop', default=0, dest='border', type=parse_border,
+                        help="Crop border in pixels, or 'auto' to detect the collar on each side")
     parser.add_argument('-n', '--name', dest='name', help='KML folder name for output')
     parser.add_argument('-o', '--draw-order', dest='order', type=int, default=20, help='KML draw order')
     parser.add_argument('-t', '--tile-size', dest='tile_size', default=1024, type=int, help='Max tile size [1024]')
+    parser.add_argument('--scale', dest='scale', type=float, help='Scale the image by this factor before tiling')
+    parser.add_argument('--max-tiles', dest='max_tiles', type=int,
+                        help='Scale the image down as far as needed to fit in this many tiles')
+    parser.add_argument('--resampling', dest='resampling', default='average',
+                        help='GDAL resampling algorithm used when scaling or warping [average]')
+    parser.add_argument('-w', '--warp', dest='warp', action='store_true',
+                        help='Reproject sources not in EPSG:4326 as the tiles are read')
+    parser.add_argument('--quad', dest='quad', action='store_true',
+                        help='Place tiles of rotated or projected sources by their corners with gx:LatLonQuad, '
+                             'warping only if that is out by more than --quad-tolerance')
+    parser.add_argument('--passthrough', dest='passthrough', action='store_true',
+                        help='Copy the blocks of JPEG compressed GeoTIFFs into the tiles without re-encoding them')
+    parser.add_argument('--quad-tolerance', dest='quad_tolerance', default=1.0, type=float,
+                        help='Largest error in pixels allowed for --quad [1]')
+    parser.add_argument('-p', '--pixel-budget', dest='pixel_budget', action='store_true',
+                        help='Allow tiles of any shape up to tile size squared pixels')
     parser.add_argument('-q', '--quality', dest='quality', default=75, type=int, help='JPEG quality [75]')
+    parser.add_argument('-e', '--encoder', dest='encoder', default='gdal', choices=sorted(ENCODERS),
+                        help='JPEG encoder [gdal]')
+    parser.add_argument('-s', '--skip-blank', dest='skip_blank', action='store_true',
+                        help='Leave out single colour tiles and those without data')
+    parser.add_argument('--min-coverage', dest='min_coverage', default=0.0, type=float,
+                        help='With --skip-blank, also leave out tiles with less than this fraction of data [0]')
+    parser.add_argument('--cache', dest='cache', help='Directory to cache encoded tiles in between runs')
+    parser.add_argument('--cache-size', dest='cache_size', default=1024, type=int, help='Max tile cache size in MB [1024]')
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true',
+                        help='Keep the tiles an interrupted run finished and only create the rest')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int, help='Number of tiling processes [1]')
+    parser.add_argument('--shared-strips', dest='shared_strips', action='store_true',
+                        help='With --jobs, read each row of tiles once into memory shared with the processes')
+    parser.add_argument('--threads', dest='threads', default=1, type=int,
+                        help='Number of encoder threads when not using --jobs [1]')
+    parser.add_argument('--queue-depth', dest='queue_depth', default=8, type=int,
+                        help='Most tiles read ahead of being written when not using --jobs [8]')
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true',
+                        help='src_file is a directory or glob and dst_file the output directory, '
+                             'with --jobs files converted at once')
+    parser.add_argument('--kmz', dest='kmz', action='store_true', help='Write .kmz files in batch mode')
+    parser.add_argument('--stats', dest='stats', metavar='FILE',
+                        help='Write a JSON report of the time, bytes and pixels of each stage to FILE')
+    parser.add_argument('--plan', dest='plan', action='store_true',
+                        help='Only report the tiles, output size and memory that would be used')
+    parser.add_argument('--plan-format', dest='plan_format', default='text', choices=['text', 'json'],
+                        help='Format of the --plan report [text]')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
 
     args = parser.parse_args()
 
-    source_file, destination_file = Path(args.src_file), Path(args.dst_file)
+    if not args.dst_file and not args.plan:
+        parser.error('dst_file is required')
+    if args.threads < 1 or args.queue_depth < 1:
+        parser.error('--threads and --queue-depth must be at least 1')
+
+    source_file = Path(args.src_file)
+    min_coverage = args.min_coverage if args.skip_blank else None
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
+    elif args.batch:
+        logging.basicConfig(level=logging.INFO)
+
+    cache = None
+    if args.cache:
+        cache = TileCache(args.cache, args.cache_size * 1024 ** 2)
+
+    if args.plan:
+        # A dry run, for one file or every file a batch would convert
+        if args.batch:
+            sources = find_sources(args.src_file)
+            if not sources:
+                parser.error(f'no source files found in {args.src_file}')
+        elif not source_file.exists():
+            parser.error('unable to file src_file')
+        else:
+            sources = [source_file]
+
+        plans, failed = [], False
+        for source in map(Path, sources):
+            try:
+                plans.append(plan_kml(source,
+                                      tile_size=args.tile_size,
+                                      border=args.border,
+                                      exclude=load_exclude(source),
+                                      quality=args.quality,
+                                      jobs=args.jobs,
+                                      encoder=args.encoder,
+                                      pixel_budget=args.pixel_budget,
+                                      scale=args.scale,
+                                      max_tiles=args.max_tiles,
+                                      resampling=args.resampling,
+                                      warp=args.warp,
+                                      quad=args.quad,
+                                      quad_tolerance=args.quad_tolerance,
+                                      passthrough=args.passthrough,
+                                      queue_depth=args.queue_depth,
+                                      shared_strips=args.shared_strips))
+            except Exception as e:
+                if not args.batch:
+                    raise
+                logging.error(f'{source}: {e}')
+                failed = True
+
+        if args.plan_format == 'json':
+            print(json.dumps(plans if args.batch else plans[0], indent=2))
+        else:
+            print('\n\n'.join(format_plan(plan) for plan in plans))
+        sys.exit(1 if failed else 0)
+
+    if args.batch:
+        if args.stats:
+            parser.error('--stats is for a single file, not --batch')
+        if args.kmz and args.resume:
+            parser.error('--resume needs .kml output, not --kmz')
+        sources = find_sources(args.src_file)
+        if not sources:
+            parser.error(f'no source files found in {args.src_file}')
+        stems = [source.stem for source in sources]
+        if len(set(stems)) < len(stems):
+            parser.error('source files with the same name would be written to the same output: ' +
+                         ', '.join(sorted({str(source) for source in sources if stems.count(source.stem) > 1})))
+        reports = batch_kml(sources, args.dst_file,
+                            jobs=args.jobs,
+                            kmz=args.kmz,
+                            tile_size=args.tile_size,
+                            border=args.border,
+                            order=args.order,
+                            quality=args.quality,
+                            encoder=args.encoder,
+                            cache=cache,
+                            resume=args.resume,
+                            pixel_budget=args.pixel_budget,
+                            min_coverage=min_coverage,
+                            scale=args.scale,
+                            max_tiles=args.max_tiles,
+                            resampling=args.resampling,
+                            warp=args.warp,
+                            quad=args.quad,
+                            quad_tolerance=args.quad_tolerance,
+                            passthrough=args.passthrough,
+                            threads=args.threads,
+                            queue_depth=args.queue_depth,
+                            shared_strips=args.shared_strips)
+        # Fail the run if any file did, so scripts notice
+        sys.exit(1 if any('error' in report for report in reports) else 0)
 
     # validate a few options
     if not source_file.exists():
         parser.error('unable to file src_file')
 
-    # set the default folder for jpegs
-    if not args.directory:
-        directory = destination_file.with_suffix('.files')
-    else:
-        directory = Path(args.directory)
+    exclude = load_exclude(source_file)
 
-    directory.mkdir(exist_ok=True)
+    destination_file = Path(args.dst_file)
+    stats = Stats() if args.stats else None
 
-    logging.info(f'Writing jpegs to {args.directory}')
+    # set the default folder for jpegs, a kmz gets its tiles written straight into the archive
+    if destination_file.suffix.lower() == '.kmz':
+        if args.resume:
+            parser.error('--resume needs a .kml dst_file')
+        directory = None
+    else:
+        if not args.directory:
+            directory = destination_file.with_suffix('.files')
+        else:
+            directory = Path(args.directory)
 
-    # load the exclude file
-    exclude_file = source_file.with_suffix('.exclude')
-    exclude = []
-    if exclude_file.exists():
-        logging.debug(f"Using exclude file {exclude_file}")
-        for line in open(exclude_file):
-            exclude.append(line.rstrip())
-        logging.debug(exclude)
+        directory.mkdir(exist_ok=True)
+
+        logging.info(f'Writing jpegs to {directory}')
 
     create_kml(source_file, destination_file, directory,
                tile_size=args.tile_size,
@@ -249,4 +1931,24 @@ if __name__ == '__main__':
                name=args.name,
                order=args.order,
                exclude=exclude,
-               quality=args.quality)
+               quality=args.quality,
+               jobs=args.jobs,
+               encoder=args.encoder,
+               cache=cache,
+               resume=args.resume,
+               pixel_budget=args.pixel_budget,
+               min_coverage=min_coverage,
+               scale=args.scale,
+               max_tiles=args.max_tiles,
+               resampling=args.resampling,
+               warp=args.warp,
+               quad=args.quad,
+               quad_tolerance=args.quad_tolerance,
+               passthrough=args.passthrough,
+               threads=args.threads,
+               queue_depth=args.queue_depth,
+               shared_strips=args.shared_strips,
+               stats=stats)
+
+    if stats is not None:
+        stats.write(args.stats)
@@ -1,10 +1,19 @@
 import argparse
+import hashlib
+import io
 import logging
 import re
+import sys
+import time
+import xml.sax
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from xml.sax.handler import ContentHandler, LexicalHandler
+from xml.sax.saxutils import XMLGenerator
 
-from xml.dom.minidom import parse
+from stats import Stats
 
 
 def htc(m):
@@ -16,13 +25,255 @@ def urldecode(url):
     return rex.sub(htc, url)
 
 
+def stored_name(data, suffix):
+    """
+    Name an image in the archive after its content, so identical images are stored once and
+    keep the same name from one run to the next.
+    """
+    return f'files/{hashlib.sha256(data).hexdigest()[:16]}{suffix.lower()}'
+
+
+def read_data(source):
+    """
+    Read all of a path, bytes-like object or binary file-like object.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if hasattr(source, 'read'):
+        return source.read()
+    return Path(source).read_bytes()
+
+
+def load_image(href, images=None, base=None):
+    """
+    Read the image an href points to, taking it from images if it is there by href, and
+    otherwise from the file at the href as it is or relative to base.
+    Returns (name for logging, data, ZipInfo to store it under its stored_name).
+    """
+    path = Path(urldecode(href).replace('file:///', ''))
+    if images is not None and (href in images or str(path) in images):
+        data = read_data(images[href] if href in images else images[str(path)])
+        return href, data, zipfile.ZipInfo(stored_name(data, path.suffix), time.localtime()[:6])
+
+    if not path.exists() and base is not None:
+        path = Path(base) / path
+
+    data = path.read_bytes()
+    return path, data, zipfile.ZipInfo.from_file(path, stored_name(data, path.suffix))
+
+
+def prefetch(function, items, threads=8):
+    """
+    Yield function(item) for each item in order, while a pool of threads runs it for up to
+    2 * threads items ahead. Slow reads overlap each other rather than adding up.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(threads) as pool:
+        try:
+            for item in items:
+                pending.append(pool.submit(function, item))
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def local_name(name):
+    return name.rpartition(':')[2]
+
+
+class HrefCollector(ContentHandler):
+    """
+    Collect the text of every href in a KML document, in document order, without keeping the document.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hrefs = []
+        self._text = None
+
+    def startElement(self, name, attrs):
+        if local_name(name) == 'href':
+            self._text = []
+
+    def characters(self, content):
+        if self._text is not None:
+            self._text.append(content)
+
+    def endElement(self, name):
+        if self._text is not None and local_name(name) == 'href':
+            self.hrefs.append(''.join(self._text))
+            self._text = None
+
+
+class HrefRewriter(XMLGenerator, LexicalHandler):
+    """
+    Copy a KML document to out as it is parsed, replacing the text of each href by its entry in hrefs.
+    """
+
+    def __init__(self, out, hrefs):
+        super().__init__(out, 'utf-8', short_empty_elements=True)
+        self.hrefs = hrefs
+        self._text = None
+
+    def startElement(self, name, attrs):
+        super().startElement(name, attrs)
+        if local_name(name) == 'href':
+            self._text = []
+
+    def characters(self, content):
+        if self._text is not None:
+            self._text.append(content)
+        else:
+            super().characters(content)
+
+    def endElement(self, name):
+        if self._text is not None and local_name(name) == 'href':
+            text = ''.join(self._text)
+            self._text = None
+            super().characters(self.hrefs.get(text, text))
+        super().endElement(name)
+
+    def comment(self, content):
+        # Close off a start tag that is still open in case the element turns out to be empty
+        self._finish_pending_start_element()
+        self._write(f'<!--{content}-->')
+
+
+def parse_kml(source, handler, chunk_size=1024 ** 2):
+    """
+    Parse the KML from a path or binary file-like object into a SAX handler a chunk at a time.
+    A file-like object is left open.
+    """
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    if isinstance(handler, LexicalHandler):
+        parser.setProperty(xml.sax.handler.property_lexical_handler, handler)
+
+    f = open(source, 'rb') if isinstance(source, (str, Path)) else source
+    try:
+        while chunk := f.read(chunk_size):
+            parser.feed(chunk)
+        parser.close()
+    finally:
+        if f is not source:
+            f.close()
+
+
+def rewrite_kml(source, out, hrefs):
+    """
+    Stream the KML from source to the binary file out with its hrefs replaced, holding no more
+    than the element being copied in memory.
+    """
+    parse_kml(source, HrefRewriter(out, hrefs))
+
+
+def build_kmz(kml, images=None, out=None, threads=8, stats=None):
+    """
+    Package a KML and the images its hrefs point to as a KMZ written to out, a path or binary stream.
+    Without out the KMZ is built in memory and its bytes are returned.
+    The stream doesn't need to be seekable, in which case each entry is followed by a data
+    descriptor, so a pipe or HTTP response gets the archive as each image is added.
+
+    The KML can be a path, bytes or a binary file-like object, and is read twice: once for
+    its hrefs and once as it is copied into the archive. A file-like object that can't seek
+    back is read into memory first. Images are taken from the images mapping of href to path,
+    bytes or file-like object, and otherwise read from the files the hrefs point to, relative
+    to the KML's directory if it is a path. Each distinct image is stored once, named after its
+    content, and the time and bytes of each stage are recorded in stats.
+
+    Raises FileNotFoundError if an image can't be found.
+    """
+    if stats is None:
+        stats = Stats()
+
+    base = None
+    if isinstance(kml, (bytes, bytearray, memoryview)):
+        kml = io.BytesIO(kml)
+    elif not hasattr(kml, 'read'):
+        kml = Path(kml)
+        base = kml.parent
+    elif not kml.seekable():
+        kml = io.BytesIO(kml.read())
+
+    start = None if isinstance(kml, Path) else kml.tell()
+
+    def rewind():
+        if isinstance(kml, Path):
+            return kml
+        kml.seek(start)
+        return kml
+
+    # read the source xml, only the hrefs are kept
+    with stats.timed('parse') as counts:
+        collector = HrefCollector()
+        parse_kml(rewind(), collector)
+        counts['bytes'] = kml.stat().st_size if isinstance(kml, Path) else kml.tell() - start
+
+    def load(href):
+        started = time.perf_counter()
+        with stats.timed('read') as counts:
+            loaded = load_image(href, images, base)
+            counts['bytes'] = len(loaded[1])
+        stats.tile(time.perf_counter() - started)
+        return loaded
+
+    # create the output zip file
+    buffer = io.BytesIO() if out is None else None
+    zipped = zipfile.ZipFile(buffer if out is None else out, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        # the images are read and hashed by a pool of threads, and added to the archive here in order
+        unique = list(dict.fromkeys(collector.hrefs))
+        hrefs = {}
+        stored = set()
+        for href, (name, data, info) in zip(unique, prefetch(load, unique, threads)):
+            # add the image, unless one with the same content already has been
+            if info.filename in stored:
+                logging.debug(f"{name} is the same as {info.filename}")
+            else:
+                logging.debug(f"Storing {name} as {info.filename}")
+                with stats.timed('write', len(data)):
+                    zipped.writestr(info, data, zipfile.ZIP_STORED)
+                stored.add(info.filename)
+
+            # point the xml to the correct image
+            hrefs[href] = info.filename
+
+        logging.info(f"Stored {len(stored)} images for {len(hrefs)} different hrefs")
+
+        # the xml is parsed again and written straight into the archive as it goes
+        logging.debug("Storing KML as doc.kml")
+        with stats.timed('kml') as counts:
+            info = zipfile.ZipInfo('doc.kml', time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # The size isn't known up front, so allow for it going past 4GB
+            with zipped.open(info, 'w', force_zip64=True) as doc:
+                rewrite_kml(rewind(), doc, hrefs)
+            counts['bytes'] = zipped.getinfo('doc.kml').file_size
+    finally:
+        zipped.close()
+
+    # Only what went into the archive, images read are counted again when they're written
+    stats.values['bytes'] = sum(stats.stages[name]['bytes'] for name in ('write', 'kml') if name in stats.stages)
+
+    if buffer is not None:
+        return buffer.getvalue()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Convert KML file to KMZ (Garmin CustomMap) file'
     )
     parser.add_argument('src_file', metavar='src_file', type=str, help='Source file')
 
-    parser.add_argument('-o', '--outfile', dest="outfile", metavar="FILE", help="Write output to FILE")
+    parser.add_argument('-o', '--outfile', dest="outfile", metavar="FILE", help="Write output to FILE, or - for stdout")
+    parser.add_argument('-j', '--threads', dest='threads', default=8, type=int,
+                        help='Number of images read at once [8]')
+    parser.add_argument('--stats', dest='stats', metavar='FILE',
+                        help='Write a JSON report of the time and bytes of each stage to FILE')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
 
     args = parser.parse_args()
@@ -39,37 +290,19 @@ if __name__ == '__main__':
     if not args.outfile:
         # If no output file is given, use input filename with .kmz extension
         args.outfile = src_file.with_suffix('.kmz')
-    logging.info("Output to", args.outfile)
-
-    # create the output zip file
-    zipped = zipfile.ZipFile(args.outfile, 'w', zipfile.ZIP_DEFLATED)
+    logging.info(f"Output to {args.outfile}")
 
-    # read the source xml
-    kml = parse(str(src_file))
-    nodes = kml.getElementsByTagName('href')
+    stats = Stats()
 
-    base = src_file.parent
+    # stdout is usually a pipe that can't seek, which zipfile handles by writing data descriptors
+    out = sys.stdout.buffer if args.outfile == '-' else args.outfile
 
-    for node in nodes:
-        href = node.firstChild
+    try:
+        build_kmz(src_file, out=out, threads=args.threads, stats=stats)
+    except FileNotFoundError as e:
+        parser.error(f'Unable to find image: {e.filename}')
 
-        img = Path(urldecode(href.nodeValue).replace('file:///', ''))
-        if not img.exists():
-            img = base / img
-
-        if not img.exists():
-            parser.error(f'Unable to find image: {img}')
-
-        # add the image
-        filename = Path('files') / img.name
-        logging.debug(f"Storing {img} as {filename}")
-        zipped.write(img, filename, zipfile.ZIP_STORED)
-
-        # modify the xml to point to the correct image
-        href.nodeValue = filename
-
-    logging.debug("Storing KML as doc.kml")
-    zipped.writestr('doc.kml', kml.toxml("UTF-8"))
-
-    zipped.close()
     logging.info("Finished")
+
+    if args.stats:
+        stats.write(args.stats)
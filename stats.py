@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+
+class Stats:
+    """
+    Wall and CPU time, bytes and pixels spent in each stage of a conversion, and how long each
+    tile or image took, for writing out as a JSON report. Stages can be added to from any thread.
+    CPU time is that of the thread doing the work, so stages running at once aren't double counted.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.latencies = []
+        self.values = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def add(self, name: str, seconds: float, cpu_seconds: float = 0.0, nbytes: int = 0, pixels: int = 0) -> None:
+        with self._lock:
+            stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                                  'bytes': 0, 'pixels': 0})
+            stage['count'] += 1
+            stage['seconds'] += seconds
+            stage['cpu_seconds'] += cpu_seconds
+            stage['bytes'] += nbytes
+            stage['pixels'] += pixels
+
+    @contextmanager
+    def timed(self, name: str, nbytes: int = 0, pixels: int = 0) -> Iterator[dict]:
+        """
+        Time the block as one pass through a stage. The bytes and pixels can be filled in on
+        the dict it gives once they are known.
+        """
+        counts = {'bytes': nbytes, 'pixels': pixels}
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.perf_counter() - start, time.thread_time() - cpu, counts['bytes'], counts['pixels'])
+
+    def tile(self, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def report(self) -> dict:
+        seconds = time.perf_counter() - self._start
+
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = {
+                **stage,
+                'megabytes_per_second': stage['bytes'] / 1e6 / stage['seconds'] if stage['seconds'] else 0.0,
+                'megapixels_per_second': stage['pixels'] / 1e6 / stage['seconds'] if stage['seconds'] else 0.0,
+            }
+
+        latencies = sorted(self.latencies)
+        report = {
+            'seconds': seconds,
+            'cpu_seconds': time.process_time() - self._cpu,
+            'stages': stages,
+            'tiles': len(latencies),
+            'tile_seconds': {
+                f'p{p}': percentile(latencies, p) for p in (50, 90, 99)
+            } | {'max': latencies[-1] if latencies else 0.0},
+            **self.values,
+        }
+        # Overall rates from the totals the conversion set
+        if 'pixels' in self.values:
+            report['megapixels_per_second'] = self.values['pixels'] / 1e6 / seconds
+        if 'bytes' in self.values:
+            report['megabytes_per_second'] = self.values['bytes'] / 1e6 / seconds
+        return report
+
+    def write(self, filename: str | Path) -> None:
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest rank percentile of already sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]